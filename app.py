@@ -1,139 +1,237 @@
+from __future__ import annotations
+
 import os
-import gradio as gr
-from PIL import Image
 import io
-import requests
-from typing import Optional, Tuple
+import asyncio
+import random
+import hashlib
+import tempfile
+from typing import IO, TYPE_CHECKING, List, Optional, Tuple
+
+from utils import (
+    MAX_CONCURRENT_REQUESTS,
+    aquery_hf_api,
+    aquery_hf_api_batch,
+    craft_realistic_prompt,
+    find_similar_prompt,
+    remember_prompt,
+    trim_directory
+)
+
+# Pillow and Gradio are imported where they are first used so that
+# importing this module (and utils.py) stays cheap
+if TYPE_CHECKING:
+    from PIL import Image
+
+NUM_VARIATIONS = 4
 
-def load_environment():
+# Download formats offered in the UI: label -> (PIL format, extension, lossless)
+OUTPUT_FORMATS = {
+    "WebP": ("WEBP", "webp", False),
+    "WebP (lossless)": ("WEBP", "webp", True),
+    "PNG": ("PNG", "png", True),
+    "JPEG": ("JPEG", "jpg", False),
+}
+DEFAULT_OUTPUT_FORMAT = "WebP"
+
+# Encoded downloads, named by image content and format. Registered as a
+# Gradio static path so files are served in place instead of being
+# copied into Gradio's cache. Anchored to this file so launching from
+# another directory serves the same folder
+DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+DOWNLOAD_MAXFILES = 512
+
+def convert_image(
+    image: Image.Image,
+    format: str = "webp",
+    lossless: bool = False,
+    fp: Optional[IO[bytes]] = None
+) -> IO[bytes]:
     """
-    Attempt to load environment variables with error handling.
+    Encode an image for download.
+    
+    WebP is the default: at quality 85 it is a fraction of the size of
+    the equivalent PNG with no visible difference. The image is encoded
+    straight into fp, so no extra copy of the encoded bytes is made.
+    
+    Args:
+        image (Image.Image): Image to encode
+        format (str): Target format (webp, png or jpeg)
+        lossless (bool): Use lossless WebP compression
+        fp (Optional[IO[bytes]]): Writable binary file, a new BytesIO if None
     
     Returns:
-        Optional[str]: Hugging Face Token or None
+        IO[bytes]: The file written to; a new BytesIO is rewound to the start
     """
-    try:
-        from dotenv import load_dotenv
-        load_dotenv()
-    except ImportError:
-        print("python-dotenv not installed. Ensure HF_TOKEN is set in environment.")
+    if fp is None:
+        fp = io.BytesIO()
+        rewind = True
+    else:
+        rewind = False
+    format = format.upper()
     
-    return os.getenv("HF_TOKEN")
+    if format == "WEBP":
+        if lossless:
+            image.save(fp, format="WEBP", lossless=True, method=6)
+        else:
+            image.save(fp, format="WEBP", quality=85, method=6)
+    elif format == "JPEG":
+        image.save(fp, format="JPEG", quality=95)
+    else:
+        image.save(fp, format=format)
+    
+    if rewind:
+        fp.seek(0)
+    return fp
 
-def craft_realistic_prompt(base_prompt: str) -> str:
+def save_download(image: Image.Image, image_id: str, output_format: str) -> str:
     """
-    Enhance prompts for more photorealistic results
+    Write the image to the download cache, reusing an existing file.
     
     Args:
-        base_prompt (str): Original user prompt
+        image (Image.Image): Generated image
+        image_id (str): Content hash identifying the generated image
+        output_format (str): Label from OUTPUT_FORMATS
     
     Returns:
-        str: Enhanced, detailed prompt
+        str: Path of the downloadable file
     """
-    realistic_modifiers = [
-        "photorealistic",
-        "high resolution",
-        "sharp focus",
-        "professional photography",
-        "natural lighting",
-        "detailed textures"
-    ]
+    if output_format not in OUTPUT_FORMATS:
+        output_format = DEFAULT_OUTPUT_FORMAT
+    pil_format, extension, lossless = OUTPUT_FORMATS[output_format]
     
-    # Combine base prompt with realistic modifiers
-    enhanced_prompt = f"{' '.join(realistic_modifiers)}, {base_prompt}, shot on professional camera, 8k resolution"
+    # Lossy and lossless WebP share an extension, so the variant is part of the name
+    variant = "-lossless" if lossless and pil_format == "WEBP" else ""
+    path = os.path.join(DOWNLOAD_DIR, f"{image_id}{variant}.{extension}")
+    try:
+        # Refresh the mtime so trim_directory evicts least recently used files
+        os.utime(path)
+        return path
+    except OSError:
+        pass
     
-    return enhanced_prompt
+    # Write to a temporary name first so concurrent requests never serve a partial file
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=DOWNLOAD_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            convert_image(image, pil_format, lossless, fp=f)
+        os.replace(temp_path, path)
+    except Exception:
+        # trim_directory skips .tmp files, so clean up here
+        os.unlink(temp_path)
+        raise
+    trim_directory(DOWNLOAD_DIR, DOWNLOAD_MAXFILES)
+    
+    return path
 
-def query_hf_api(
-    prompt: str, 
-    model_url: str = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0",
-    max_retries: int = 3
-) -> Optional[bytes]:
+def decode_image(image_bytes: bytes) -> Image.Image:
     """
-    Query the Hugging Face Inference API with robust error handling and retry mechanism.
+    Decode API response bytes into an RGB PIL Image.
     
     Args:
-        prompt (str): Text prompt for image generation
-        model_url (str): URL of the Hugging Face model
-        max_retries (int): Maximum number of retry attempts
+        image_bytes (bytes): Encoded image returned by the API
     
     Returns:
-        Optional[bytes]: Generated image bytes or None
-    """
-    # Validate inputs
-    if not prompt or not prompt.strip():
-        raise ValueError("Prompt cannot be empty")
-    
-    # Load token
-    HF_TOKEN = load_environment()
-    if not HF_TOKEN:
-        raise ValueError("Hugging Face token not found. Set HF_TOKEN in .env or environment variables.")
-    
-    # Prepare headers
-    headers = {
-        "Authorization": f"Bearer {HF_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    # Payload with enhanced configuration for realism
-    payload = {
-        "inputs": craft_realistic_prompt(prompt),
-        "parameters": {
-            "negative_prompt": "cartoon, anime, low quality, bad anatomy, blurry, unrealistic, painting, drawing, sketch",
-            "num_inference_steps": 75,  # Increased steps
-            "guidance_scale": 8.5,      # Higher guidance
-        }
-    }
-    
-    # Retry mechanism
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                model_url, 
-                headers=headers, 
-                json=payload,
-                timeout=120  # 2-minute timeout
-            )
-            
-            response.raise_for_status()  # Raise exception for bad status codes
-            
-            return response.content
-        
-        except requests.exceptions.RequestException as e:
-            print(f"Request error (Attempt {attempt + 1}/{max_retries}): {e}")
-            
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"Failed to generate image after {max_retries} attempts: {e}")
+        Image.Image: Decoded RGB image
+    """
+    from PIL import Image
+    
+    # Decode eagerly so the PIL image no longer references the
+    # response buffer, and only convert when the mode needs it
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    return image
 
-    raise RuntimeError("Unexpected error in image generation")
+def prepare_result(image_bytes: bytes, output_format: str) -> Tuple[Image.Image, str]:
+    """
+    Decode a generated image and write its download file.
+    
+    Args:
+        image_bytes (bytes): Encoded image returned by the API
+        output_format (str): Label from OUTPUT_FORMATS
+    
+    Returns:
+        Tuple[Image.Image, str]: Decoded image and path of the downloadable file
+    """
+    image_id = hashlib.sha256(image_bytes).hexdigest()[:16]
+    image = decode_image(image_bytes)
+    
+    return image, save_download(image, image_id, output_format)
 
-def generate_image(prompt: str) -> Tuple[Optional[Image.Image], str]:
+async def generate_image(
+    prompt: str,
+    output_format: str = DEFAULT_OUTPUT_FORMAT
+) -> Tuple[Optional[Image.Image], Optional[str], str]:
     """
     Generate an image from a text prompt.
     
     Args:
         prompt (str): Text description for image generation
+        output_format (str): Download format label from OUTPUT_FORMATS
     
     Returns:
-        Tuple[Optional[Image.Image], str]: 
-        Generated PIL Image and status message
+        Tuple[Optional[Image.Image], Optional[str], str]: 
+        Generated PIL Image, path of the downloadable file and status message
     """
     try:
         # Validate prompt
         if not prompt or not prompt.strip():
-            return None, "Error: Prompt cannot be empty"
+            return None, None, "Error: Prompt cannot be empty"
+        
+        # Reuse an earlier prompt that differs only in case, punctuation or articles
+        prompt = find_similar_prompt(prompt) or prompt
         
         # Generate image bytes
-        image_bytes = query_hf_api(prompt)
+        image_bytes = await aquery_hf_api(craft_realistic_prompt(prompt))
         
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        # Hashing, decoding and WebP encoding are CPU-bound; run them off
+        # the event loop so other users' requests keep progressing
+        image, download_path = await asyncio.to_thread(prepare_result, image_bytes, output_format)
+        del image_bytes
+        remember_prompt(prompt)
         
-        return image, "Image generated successfully!"
+        return image, download_path, "Image generated successfully!"
     
     except Exception as e:
         print(f"Image generation error: {e}")
-        return None, f"Error: {str(e)}"
+        return None, None, f"Error: {str(e)}"
+
+async def generate_variations(prompt: str) -> Tuple[List[Image.Image], str]:
+    """
+    Generate several variations of a prompt concurrently.
+    
+    Args:
+        prompt (str): Text description for image generation
+    
+    Returns:
+        Tuple[List[Image.Image], str]: 
+        Generated PIL Images and status message
+    """
+    try:
+        # Validate prompt
+        if not prompt or not prompt.strip():
+            return [], "Error: Prompt cannot be empty"
+        
+        # Same prompt, different seeds; random seeds never repeat, so
+        # skip the response cache instead of filling it with dead entries
+        enhanced_prompt = craft_realistic_prompt(prompt)
+        images_bytes = await aquery_hf_api_batch(
+            [enhanced_prompt] * NUM_VARIATIONS,
+            seeds=[random.randrange(2**32) for _ in range(NUM_VARIATIONS)],
+            use_cache=False
+        )
+        
+        images = await asyncio.to_thread(lambda: [decode_image(image_bytes) for image_bytes in images_bytes])
+        
+        return images, f"{len(images)} variations generated successfully!"
+    
+    except Exception as e:
+        print(f"Variation generation error: {e}")
+        return [], f"Error: {str(e)}"
 
 def create_gradio_interface():
     """
@@ -142,6 +240,11 @@ def create_gradio_interface():
     Returns:
         gr.Blocks: Configured Gradio interface
     """
+    import gradio as gr
+    
+    # Serve downloads straight from DOWNLOAD_DIR without copying them
+    gr.set_static_paths([DOWNLOAD_DIR])
+    
     with gr.Blocks(
         theme=gr.themes.Soft(), 
         title="🎨 AI Image Generator"
@@ -161,16 +264,35 @@ def create_gradio_interface():
                     lines=3
                 )
                 
-                # Generate Button
+                # Download Format
+                format_dropdown = gr.Dropdown(
+                    label="Download format",
+                    choices=list(OUTPUT_FORMATS),
+                    value=DEFAULT_OUTPUT_FORMAT
+                )
+                
+                # Generate Buttons
                 generate_button = gr.Button("✨ Generate Image", variant="primary")
+                variations_button = gr.Button(f"🎲 Generate {NUM_VARIATIONS} Variations")
             
             # Output Image Display
             with gr.Column(scale=4):
                 output_image = gr.Image(
                     label="Generated Image", 
                     type="pil", 
+                    format="webp",
                     interactive=False
                 )
+                
+                # Downloadable File
+                download_file = gr.File(label="Download Image")
+        
+        # Variations Display
+        variations_gallery = gr.Gallery(
+            label="Variations",
+            columns=NUM_VARIATIONS,
+            format="webp"
+        )
         
         # Status Output
         status_output = gr.Textbox(label="Status")
@@ -178,22 +300,45 @@ def create_gradio_interface():
         # Event Handlers
         generate_button.click(
             fn=generate_image,
+            inputs=[text_input, format_dropdown],
+            outputs=[output_image, download_file, status_output],
+            concurrency_limit=MAX_CONCURRENT_REQUESTS
+        )
+        variations_button.click(
+            fn=generate_variations,
             inputs=[text_input],
-            outputs=[output_image, status_output]
+            outputs=[variations_gallery, status_output],
+            concurrency_limit=MAX_CONCURRENT_REQUESTS // NUM_VARIATIONS
         )
     
     return demo
 
+def check_image_codecs() -> None:
+    """
+    Warn when Pillow lacks the SIMD JPEG decoder or WebP support.
+    
+    Official Pillow wheels bundle libjpeg-turbo and libwebp; source
+    builds against stock libjpeg decode noticeably slower.
+    """
+    from PIL import features
+    
+    if not features.check_feature("libjpeg_turbo"):
+        print("Pillow is not using libjpeg-turbo; JPEG decoding will be slower. Install the official Pillow wheel.")
+    if not features.check("webp"):
+        print("Pillow was built without WebP support; WebP downloads will fail.")
+
 def main():
     """
     Main entry point for the Gradio application.
     """
     try:
+        check_image_codecs()
         demo = create_gradio_interface()
         demo.launch(
             server_name="0.0.0.0",  # Listen on all network interfaces
             server_port=7860,  # Default Gradio port
-            share=False  # Set to True for a public link
+            # Gradio's public tunnel adds latency; opt in with GRADIO_SHARE=1 for dev only
+            share=os.getenv("GRADIO_SHARE") == "1"
         )
     except Exception as e:
         print(f"Error launching Gradio app: {e}")
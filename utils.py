@@ -1,7 +1,100 @@
 import os
+import re
+import random
+import hashlib
+import asyncio
+import tempfile
+import itertools
+import httpx
+import orjson
 import requests
-import time
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+DEFAULT_MODEL_URL = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"
+
+# Retry policy shared by the sync and async paths: connection errors,
+# rate limiting and 5xx (e.g. model still loading) are retried up to
+# MAX_RETRIES times. Both wait _retry_delay between attempts (jittered
+# exponential backoff, or Retry-After), capped at RETRY_BACKOFF_MAX;
+# other errors such as a bad token fail immediately
+MAX_RETRIES = 3
+RETRY_BACKOFF_MAX = 30
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+class _SharedRetry(Retry):
+    """urllib3 Retry that backs off on the same schedule as aquery_hf_api."""
+    
+    def get_backoff_time(self) -> float:
+        # urllib3 would retry the first failure immediately; use the
+        # async schedule instead (history holds one entry per failure)
+        if not self.history:
+            return 0.0
+        return _backoff_delay(len(self.history) - 1)
+    
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, RETRY_BACKOFF_MAX)
+
+_RETRY = _SharedRetry(
+    total=MAX_RETRIES,
+    status_forcelist=RETRY_STATUSES,
+    allowed_methods=frozenset({"POST"}),
+    raise_on_status=False
+)
+
+# Shared session so sync requests reuse pooled keep-alive connections
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=_RETRY
+))
+
+# Shared async client so concurrent generations overlap on the network
+MAX_CONCURRENT_REQUESTS = 16
+# Requests sent together by aquery_hf_api_batch, kept small for HF rate limits
+BATCH_SIZE = 4
+_async_client = httpx.AsyncClient(
+    timeout=120,  # 2-minute timeout
+    limits=httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+)
+
+# Generation settings tuned for photorealistic output
+DEFAULT_NEGATIVE_PROMPT = "cartoon, anime, low quality, bad anatomy, blurry, unrealistic, painting, drawing, sketch"
+DEFAULT_NUM_INFERENCE_STEPS = 75
+DEFAULT_GUIDANCE_SCALE = 8.5
+_DEFAULT_PARAMETERS = {
+    "negative_prompt": DEFAULT_NEGATIVE_PROMPT,
+    "num_inference_steps": DEFAULT_NUM_INFERENCE_STEPS,
+    "guidance_scale": DEFAULT_GUIDANCE_SCALE,
+}
+
+# Fixed modifiers wrapped around every prompt for photorealistic results
+_REALISTIC_PREFIX = "photorealistic high resolution sharp focus professional photography natural lighting detailed textures"
+_REALISTIC_SUFFIX = ", shot on professional camera, 8k resolution"
+
+# In-memory LRU of recent responses, backed by a bounded disk directory
+# so repeated prompts survive restarts
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".hf_cache")
+CACHE_MAXSIZE = 256
+CACHE_DISK_MAXFILES = 1024
+# Trimming scans the whole directory, so only do it every N disk writes
+CACHE_TRIM_INTERVAL = 32
+_image_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_disk_writes = itertools.count(1)
+
+# Recently generated prompts keyed by normalized wording, used to map
+# trivially different re-submissions onto a prompt whose image is cached
+PROMPT_INDEX_MAXSIZE = 512
+_prompt_index: "OrderedDict[str, str]" = OrderedDict()
+_FILLER_WORDS = frozenset({"a", "an", "the"})
 
 def load_environment():
     """
@@ -18,74 +111,442 @@ def load_environment():
     
     return os.getenv("HF_TOKEN")
 
-def query_hf_api(
-    prompt: str, 
-    model_url: str = "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0",
-    max_retries: int = 3
-) -> Optional[bytes]:
+# Resolve the token and request headers once at import
+_HF_TOKEN = load_environment()
+_HEADERS = {
+    "Authorization": f"Bearer {_HF_TOKEN}",
+    "Content-Type": "application/json"
+}
+
+@lru_cache(maxsize=1024)
+def craft_realistic_prompt(base_prompt: str) -> str:
     """
-    Query the Hugging Face Inference API with robust error handling and retry mechanism.
+    Enhance prompts for more photorealistic results
+    
+    Args:
+        base_prompt (str): Original user prompt
+    
+    Returns:
+        str: Enhanced, detailed prompt
+    """
+    return f"{_REALISTIC_PREFIX}, {base_prompt}{_REALISTIC_SUFFIX}"
+
+def make_cache_key(body: bytes, model_url: str) -> str:
+    """
+    Build a stable cache key for an inference request.
     
     Args:
-        prompt (str): Text prompt for image generation
+        body (bytes): Serialized request payload with sorted keys
         model_url (str): URL of the Hugging Face model
-        max_retries (int): Maximum number of retry attempts
     
     Returns:
-        Optional[bytes]: Generated image bytes or None
+        str: SHA-256 hex digest identifying the request
+    """
+    return hashlib.sha256(model_url.encode() + body).hexdigest()
+
+def get_cached_image(key: str) -> Optional[bytes]:
+    """
+    Look up generated image bytes in the memory cache, then on disk.
+    
+    Args:
+        key (str): Cache key from make_cache_key
+    
+    Returns:
+        Optional[bytes]: Cached image bytes or None on a miss
+    """
+    content = _get_memory_cached(key)
+    if content is None:
+        content = _read_cache_file(key)
+        if content is not None:
+            _remember(key, content)
+    
+    return content
+
+def cache_image(key: str, content: bytes) -> None:
+    """
+    Store generated image bytes in memory and on disk.
+    
+    Args:
+        key (str): Cache key from make_cache_key
+        content (bytes): Image bytes returned by the API
+    """
+    _remember(key, content)
+    _write_cache_file(key, content)
+
+async def aget_cached_image(key: str) -> Optional[bytes]:
+    """Async get_cached_image; disk reads run in a worker thread."""
+    content = _get_memory_cached(key)
+    if content is None:
+        content = await asyncio.to_thread(_read_cache_file, key)
+        if content is not None:
+            _remember(key, content)
+    
+    return content
+
+async def acache_image(key: str, content: bytes) -> None:
+    """Async cache_image; disk writes and trimming run in a worker thread."""
+    _remember(key, content)
+    await asyncio.to_thread(_write_cache_file, key, content)
+
+def _get_memory_cached(key: str) -> Optional[bytes]:
+    """Return bytes from the memory cache, marking the entry as recently used."""
+    if key not in _image_cache:
+        return None
+    
+    _image_cache.move_to_end(key)
+    return _image_cache[key]
+
+def _read_cache_file(key: str) -> Optional[bytes]:
+    """Read a disk cache entry; blocking, so async callers use a thread."""
+    path = os.path.join(CACHE_DIR, key)
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        # Refresh the mtime so trim_directory evicts least recently used files
+        os.utime(path)
+    except OSError:
+        return None
+    
+    return content
+
+def _write_cache_file(key: str, content: bytes) -> None:
+    """Write a disk cache entry atomically; blocking, so async callers use a thread."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary name first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, os.path.join(CACHE_DIR, key))
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        if next(_disk_writes) % CACHE_TRIM_INTERVAL == 0:
+            trim_directory(CACHE_DIR, CACHE_DISK_MAXFILES)
+    except OSError as e:
+        # Disk cache is best-effort; the memory cache still applies
+        print(f"Could not write image cache: {e}")
+
+def trim_directory(directory: str, max_files: int) -> None:
+    """
+    Delete the oldest files in a cache directory beyond max_files.
+    
+    Files are ordered by modification time, so refreshing the mtime on
+    read keeps recently used entries. In-progress .tmp files are skipped.
+    
+    Args:
+        directory (str): Cache directory to trim
+        max_files (int): Number of files to keep
+    """
+    try:
+        entries = [
+            entry for entry in os.scandir(directory)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        ]
+    except OSError:
+        return
+    
+    if len(entries) <= max_files:
+        return
+    
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - max_files]:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            # Already removed by a concurrent trim
+            pass
+
+def _remember(key: str, content: bytes) -> None:
+    """Insert into the memory cache, evicting the least recently used entry."""
+    _image_cache[key] = content
+    _image_cache.move_to_end(key)
+    if len(_image_cache) > CACHE_MAXSIZE:
+        _image_cache.popitem(last=False)
+
+def _normalize_prompt(prompt: str) -> str:
+    """Case-folded words (any script) in their original order, without punctuation or articles."""
+    words = re.findall(r"\w+", prompt.casefold())
+    return " ".join(w for w in words if w not in _FILLER_WORDS)
+
+def find_similar_prompt(prompt: str) -> Optional[str]:
+    """
+    Find a previously generated prompt that differs only trivially.
+    
+    Matching ignores case, punctuation, whitespace and articles but keeps
+    every other word in order, so "Astronaut on Mars!" reuses
+    "an astronaut on mars" while "a cat chasing a dog" never matches
+    "a dog chasing a cat".
+    
+    Args:
+        prompt (str): User prompt to match
+    
+    Returns:
+        Optional[str]: The matching known prompt or None
+    """
+    normalized = _normalize_prompt(prompt)
+    known_prompt = _prompt_index.get(normalized)
+    if known_prompt is not None:
+        _prompt_index.move_to_end(normalized)
+    return known_prompt
+
+def remember_prompt(prompt: str) -> None:
+    """
+    Record a successfully generated prompt for find_similar_prompt.
+    
+    Args:
+        prompt (str): User prompt whose image is now cached
+    """
+    normalized = _normalize_prompt(prompt)
+    if not normalized:
+        return
+    
+    _prompt_index[normalized] = prompt
+    _prompt_index.move_to_end(normalized)
+    if len(_prompt_index) > PROMPT_INDEX_MAXSIZE:
+        _prompt_index.popitem(last=False)
+
+def _build_payload(
+    prompt: str,
+    negative_prompt: str,
+    num_inference_steps: int,
+    guidance_scale: Optional[float],
+    seed: Optional[int] = None
+) -> bytes:
+    """Serialize the Inference API request body; keys are sorted so it doubles as a cache key."""
+    if (negative_prompt, num_inference_steps, guidance_scale, seed) == (
+        DEFAULT_NEGATIVE_PROMPT, DEFAULT_NUM_INFERENCE_STEPS, DEFAULT_GUIDANCE_SCALE, None
+    ):
+        parameters = _DEFAULT_PARAMETERS
+    else:
+        parameters = {
+            "negative_prompt": negative_prompt,
+            "num_inference_steps": num_inference_steps,
+        }
+        if guidance_scale is not None:
+            parameters["guidance_scale"] = guidance_scale
+        if seed is not None:
+            parameters["seed"] = seed
+    
+    return orjson.dumps({"inputs": prompt, "parameters": parameters}, option=orjson.OPT_SORT_KEYS)
+
+def _prepare_request(
+    prompt: str,
+    negative_prompt: str,
+    num_inference_steps: int,
+    guidance_scale: Optional[float],
+    seed: Optional[int],
+    model_url: str,
+    use_cache: bool
+) -> Tuple[bytes, str, Optional[bytes]]:
+    """
+    Shared prologue of query_hf_api and aquery_hf_api.
+    
+    Validates the prompt, serializes the body and checks the memory
+    cache; the disk cache is left to the caller so the async path can
+    read it off the event loop.
+    
+    Returns:
+        Tuple[bytes, str, Optional[bytes]]: Request body, cache key and memory-cached bytes
     """
     # Validate inputs
     if not prompt or not prompt.strip():
         raise ValueError("Prompt cannot be empty")
     
-    # Load token
-    HF_TOKEN = load_environment()
-    if not HF_TOKEN:
+    body = _build_payload(prompt, negative_prompt, num_inference_steps, guidance_scale, seed)
+    cache_key = make_cache_key(body, model_url)
+    cached = _get_memory_cached(cache_key) if use_cache else None
+    
+    return body, cache_key, cached
+
+def _request_failure(error: Exception, status_code: Optional[int] = None) -> RuntimeError:
+    """Map a final request error to the RuntimeError raised by both query paths."""
+    if status_code is not None and status_code not in RETRY_STATUSES:
+        return RuntimeError(f"Image generation request failed: {error}")
+    
+    return RuntimeError(f"Failed to generate image after {MAX_RETRIES} retries: {error}")
+
+def _auth_headers() -> dict:
+    """Return the request headers, failing early if no token is configured."""
+    if not _HF_TOKEN:
         raise ValueError("Hugging Face token not found. Set HF_TOKEN in .env or environment variables.")
     
-    # Prepare headers
-    headers = {
-        "Authorization": f"Bearer {HF_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    # Payload with additional configuration
-    payload = {
-        "inputs": prompt,
-        "parameters": {
-            "negative_prompt": "low quality, bad anatomy, blurry",
-            "num_inference_steps": 50,
-        }
-    }
+    return _HEADERS
+
+def _backoff_delay(attempt: int) -> float:
+    """Jittered exponential backoff in seconds after the given failed attempt (0-based)."""
+    return min(2 ** attempt + random.uniform(0, 1), RETRY_BACKOFF_MAX)
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """
+    Seconds to wait before the next async attempt.
+    
+    Mirrors _SharedRetry: a Retry-After header (seconds or HTTP date) is
+    honoured but capped at RETRY_BACKOFF_MAX, otherwise jittered
+    exponential backoff applies.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(_RETRY.parse_retry_after(retry_after), RETRY_BACKOFF_MAX)
+            except InvalidHeader:
+                pass
     
-    # Retry mechanism
-    for attempt in range(max_retries):
+    return _backoff_delay(attempt)
+
+def query_hf_api(
+    prompt: str,
+    negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+    num_inference_steps: int = DEFAULT_NUM_INFERENCE_STEPS,
+    guidance_scale: Optional[float] = DEFAULT_GUIDANCE_SCALE,
+    seed: Optional[int] = None,
+    model_url: str = DEFAULT_MODEL_URL,
+    use_cache: bool = True
+) -> Optional[bytes]:
+    """
+    Query the Hugging Face Inference API with robust error handling and retry mechanism.
+    
+    Identical requests are served from the response cache without
+    touching the network. Transient failures are retried by the pooled
+    session (see MAX_RETRIES).
+    
+    Args:
+        prompt (str): Final text prompt for image generation
+        negative_prompt (str): Concepts the model should avoid
+        num_inference_steps (int): Number of denoising steps
+        guidance_scale (Optional[float]): Prompt guidance strength, model default if None
+        seed (Optional[int]): Random seed for reproducible output, random if None
+        model_url (str): URL of the Hugging Face model
+        use_cache (bool): Read and store the response cache; disable for one-off seeds
+    
+    Returns:
+        Optional[bytes]: Generated image bytes or None
+    """
+    body, cache_key, cached = _prepare_request(
+        prompt, negative_prompt, num_inference_steps, guidance_scale, seed, model_url, use_cache
+    )
+    if use_cache and cached is None:
+        cached = get_cached_image(cache_key)
+    if cached is not None:
+        return cached
+    
+    headers = _auth_headers()
+    
+    try:
+        response = _session.post(
+            model_url,
+            headers=headers,
+            data=body,
+            timeout=120  # 2-minute timeout
+        )
+        response.raise_for_status()  # Raise exception for bad status codes
+    except requests.exceptions.HTTPError as e:
+        raise _request_failure(e, e.response.status_code)
+    except requests.exceptions.RequestException as e:
+        raise _request_failure(e)
+    
+    if use_cache:
+        cache_image(cache_key, response.content)
+    return response.content
+
+async def aquery_hf_api(
+    prompt: str,
+    negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+    num_inference_steps: int = DEFAULT_NUM_INFERENCE_STEPS,
+    guidance_scale: Optional[float] = DEFAULT_GUIDANCE_SCALE,
+    seed: Optional[int] = None,
+    model_url: str = DEFAULT_MODEL_URL,
+    use_cache: bool = True
+) -> Optional[bytes]:
+    """
+    Async variant of query_hf_api sharing its response cache.
+    
+    Requests go through a pooled httpx.AsyncClient, so concurrent callers
+    wait on the API together instead of one after another. Retries follow
+    the same policy as the sync session (see MAX_RETRIES).
+    
+    Args:
+        prompt (str): Final text prompt for image generation
+        negative_prompt (str): Concepts the model should avoid
+        num_inference_steps (int): Number of denoising steps
+        guidance_scale (Optional[float]): Prompt guidance strength, model default if None
+        seed (Optional[int]): Random seed for reproducible output, random if None
+        model_url (str): URL of the Hugging Face model
+        use_cache (bool): Read and store the response cache; disable for one-off seeds
+    
+    Returns:
+        Optional[bytes]: Generated image bytes or None
+    """
+    body, cache_key, cached = _prepare_request(
+        prompt, negative_prompt, num_inference_steps, guidance_scale, seed, model_url, use_cache
+    )
+    if use_cache and cached is None:
+        cached = await aget_cached_image(cache_key)
+    if cached is not None:
+        return cached
+    
+    headers = _auth_headers()
+    
+    # Retry mechanism, matching the urllib3 Retry policy of the sync session
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
         try:
-            response = requests.post(
-                model_url, 
-                headers=headers, 
-                json=payload,
-                timeout=120  # 2-minute timeout
-            )
-            
-            # Check for specific error conditions
-            if response.status_code == 503:
-                # Model might be loading, wait and retry
-                print(f"Service unavailable, retrying in {5 * (attempt + 1)} seconds...")
-                time.sleep(5 * (attempt + 1))
-                continue
-            
+            response = await _async_client.post(model_url, headers=headers, content=body)
             response.raise_for_status()  # Raise exception for bad status codes
-            
+        except httpx.HTTPStatusError as e:
+            if response.status_code not in RETRY_STATUSES:
+                raise _request_failure(e, response.status_code)
+            error = e
+        except httpx.TransportError as e:
+            error = e
+        else:
+            if use_cache:
+                await acache_image(cache_key, response.content)
             return response.content
         
-        except requests.exceptions.RequestException as e:
-            print(f"Request error (Attempt {attempt + 1}/{max_retries}): {e}")
-            
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"Failed to generate image after {max_retries} attempts: {e}")
-            
-            # Wait before retrying
-            time.sleep(5 * (attempt + 1))
+        if attempt == MAX_RETRIES:
+            raise _request_failure(error)
+        
+        delay = _retry_delay(attempt, response)
+        print(f"Request error (Attempt {attempt + 1}/{MAX_RETRIES + 1}), retrying in {delay:.1f} seconds: {error}")
+        await asyncio.sleep(delay)
     
     raise RuntimeError("Unexpected error in image generation")
+
+async def aquery_hf_api_batch(
+    prompts: List[str],
+    seeds: Optional[List[Optional[int]]] = None,
+    batch_size: int = BATCH_SIZE,
+    **kwargs
+) -> List[bytes]:
+    """
+    Generate several images concurrently.
+    
+    The Inference API takes a single prompt per request for SDXL, so the
+    batch is fanned out client-side with asyncio.gather, batch_size
+    requests at a time.
+    
+    Args:
+        prompts (List[str]): Final text prompts, one per image
+        seeds (Optional[List[Optional[int]]]): Per-prompt seeds, parallel to prompts
+        batch_size (int): Maximum number of requests in flight
+        **kwargs: Extra arguments passed to aquery_hf_api
+    
+    Returns:
+        List[bytes]: Generated image bytes in prompt order
+    """
+    if seeds is None:
+        seeds = [None] * len(prompts)
+    if len(seeds) != len(prompts):
+        raise ValueError("seeds must have one entry per prompt")
+    
+    results = []
+    for start in range(0, len(prompts), batch_size):
+        chunk = zip(prompts[start:start + batch_size], seeds[start:start + batch_size])
+        results.extend(await asyncio.gather(
+            *(aquery_hf_api(prompt, seed=seed, **kwargs) for prompt, seed in chunk)
+        ))
+    
+    return results